@@ -134,16 +134,25 @@ app_license = "mit"
 
 doc_events = {
     "User": {
-        "before_insert": "tenant_bootstrap.usage_limits.validate_user_limit"
+        "before_insert": "tenant_bootstrap.usage_limits.validate_limit",
+        "after_insert": "tenant_bootstrap.usage_limits.invalidate_cached_count",
+        "on_update": "tenant_bootstrap.usage_limits.invalidate_cached_count",
+        "after_delete": "tenant_bootstrap.usage_limits.invalidate_cached_count"
     },
     "Customer": {
-        "before_insert": "tenant_bootstrap.usage_limits.validate_customer_limit"
+        "before_insert": "tenant_bootstrap.usage_limits.validate_limit",
+        "after_insert": "tenant_bootstrap.usage_limits.invalidate_cached_count",
+        "after_delete": "tenant_bootstrap.usage_limits.invalidate_cached_count"
     },
     "Supplier": {
-        "before_insert": "tenant_bootstrap.usage_limits.validate_supplier_limit"
+        "before_insert": "tenant_bootstrap.usage_limits.validate_limit",
+        "after_insert": "tenant_bootstrap.usage_limits.invalidate_cached_count",
+        "after_delete": "tenant_bootstrap.usage_limits.invalidate_cached_count"
     },
     "Company": {
-        "before_insert": "tenant_bootstrap.usage_limits.validate_company_limit"
+        "before_insert": "tenant_bootstrap.usage_limits.validate_limit",
+        "after_insert": "tenant_bootstrap.usage_limits.invalidate_cached_count",
+        "after_delete": "tenant_bootstrap.usage_limits.invalidate_cached_count"
     },
     "Sales Invoice": {
         "before_submit": "tenant_bootstrap.usage_limits.validate_invoice_limit"
@@ -9,11 +9,13 @@ This app must be installed on ALL tenant sites to enable automated provisioning.
 Usage:
     bench --site tenant.example.com execute \
         tenant_bootstrap.setup.setup_company \
-        --kwargs '{"config_b64": "..."}'
+        --kwargs '{"config": {"company_name": "...", ...}}'
 
     bench --site tenant.example.com execute \
         tenant_bootstrap.setup.create_user \
-        --kwargs '{"config_b64": "..."}'
+        --kwargs '{"config": {"email": "...", ...}}'
+
+The base64-encoded form (--kwargs '{"config_b64": "..."}') is still accepted.
 """
 
 import base64
@@ -22,15 +24,37 @@ import traceback
 
 import frappe
 
+from tenant_bootstrap.usage_limits import clear_cached_count
+from tenant_bootstrap.utils import update_site_config
+
+
+def _load_config(config=None, config_b64=None):
+    """
+    Get the configuration passed to a setup function as a dict (or list of dicts).
+
+    Args:
+        config: Configuration as a dict, list or JSON string
+        config_b64: Base64-encoded JSON configuration, used when `config` is not given
+
+    Returns:
+        dict | list: Decoded configuration
+    """
+    if isinstance(config, dict | list):
+        return config
+    if config:
+        return json.loads(config)
+    return json.loads(base64.b64decode(config_b64))
+
 
-def setup_company(config_b64):
+def setup_company(config_b64=None, config=None):
     """
     Set up company on a tenant site.
 
-    Called via bench execute with base64-encoded configuration.
+    Called via bench execute with the configuration as JSON (or base64-encoded JSON).
 
     Args:
-        config_b64: Base64-encoded JSON containing:
+        config_b64: Base64-encoded JSON configuration (used when `config` is not given)
+        config: Configuration dict or JSON string containing:
             - company_name
             - company_abbr
             - country
@@ -45,178 +69,327 @@ def setup_company(config_b64):
     """
     try:
         # Decode configuration
-        config = json.loads(base64.b64decode(config_b64).decode())
+        return _setup_company(_load_config(config, config_b64))
 
-        company_name = config["company_name"]
-        company_abbr = config["company_abbr"]
-        country = config["country"]
-        currency = config["currency"]
-        chart_of_accounts = config.get("chart_of_accounts", "Standard")
-        fy_name = config["fy_name"]
-        fy_start_date = config["fy_start_date"]
-        fy_end_date = config["fy_end_date"]
+    except Exception as e:
+        frappe.db.rollback()
+        print(f"SETUP_FAILED: {e!s}")
+        traceback.print_exc()
+        return {"success": False, "message": str(e)}
 
-        print(f"[SETUP] Company: {company_name}, Abbr: {company_abbr}, Country: {country}")
 
-        # Set ignore permissions for all operations
-        frappe.flags.ignore_permissions = True
+def setup_companies(configs_b64=None, configs=None):
+    """
+    Set up companies on several tenant sites in a single bench execute call.
 
-        # Step 1: Mark setup complete in site_config.json
-        site_config_path = frappe.get_site_path("site_config.json")
-        with open(site_config_path) as f:
-            site_config = json.load(f)
-        site_config["setup_complete"] = 1
-        with open(site_config_path, "w") as f:
-            json.dump(site_config, f, indent=1)
-        print("[SETUP] site_config.json updated with setup_complete=1")
+    Provisioning many tenants this way pays the Python and Frappe startup cost
+    once instead of once per tenant. Each configuration is applied to the site
+    named in its "site" key, in its own transaction.
 
-        # Step 2: Mark setup complete in System Settings and disable onboarding
-        frappe.db.set_single_value("System Settings", "setup_complete", 1)
-        frappe.db.set_single_value("System Settings", "enable_onboarding", 0)
-        frappe.db.set_single_value("System Settings", "country", country)
-        frappe.db.set_single_value("System Settings", "language", "en")
-        frappe.db.set_single_value("System Settings", "time_zone", "Asia/Kolkata")
-        frappe.db.commit()
-        print("[SETUP] System Settings updated with setup_complete=1, enable_onboarding=0")
-
-        # Step 2b: Mark all installed apps as setup complete in Installed Application table
-        # This is CRITICAL for ERPNext v16 - frappe.is_setup_complete() checks this table
-        for app_name in ["frappe", "erpnext"]:
-            if frappe.db.exists("Installed Application", {"app_name": app_name}):
-                frappe.db.set_value(
-                    "Installed Application",
-                    {"app_name": app_name},
-                    "is_setup_complete",
-                    1
-                )
-                print(f"[SETUP] Marked {app_name} as setup complete in Installed Application")
-        frappe.db.commit()
+    Usage:
+        bench --site any-tenant.example.com execute \
+            tenant_bootstrap.setup.setup_companies \
+            --kwargs '{"configs": [{"site": "...", "company_name": "...", ...}, ...]}'
 
-        # Step 2c: Set desktop home page to prevent setup wizard from being the default landing page
-        # ROOT CAUSE FIX: Without this, desktop:home_page defaults to "setup-wizard" causing infinite redirect
-        frappe.db.set_default("desktop:home_page", "home")
-        frappe.db.commit()
-        print("[SETUP] Set desktop:home_page to 'home' (prevents setup wizard redirect)")
-
-        # Step 3: Create Warehouse Types (required for ERPNext Stock module)
-        for wt in ["Transit", "Stores", "Goods In Transit", "Virtual"]:
-            if not frappe.db.exists("Warehouse Type", wt):
-                doc = frappe.get_doc({"doctype": "Warehouse Type", "name": wt})
-                doc.insert(ignore_permissions=True)
-                print(f"[SETUP] Created Warehouse Type: {wt}")
-        frappe.db.commit()
-
-        # Step 4: Create Company with Chart of Accounts
-        frappe.flags.in_setup_wizard = True
-        if not frappe.db.exists("Company", company_name):
-            print(f"[SETUP] Creating company: {company_name}")
-            company = frappe.get_doc({
-                "doctype": "Company",
-                "company_name": company_name,
-                "abbr": company_abbr,
-                "country": country,
-                "default_currency": currency,
-                "enable_perpetual_inventory": 1,
-                "chart_of_accounts": chart_of_accounts
-            })
-            company.insert(ignore_permissions=True)
+    Args:
+        configs_b64: Base64-encoded JSON list of configurations (used when `configs` is not given)
+        configs: List (or JSON string of a list) of setup_company configurations, each with:
+            - site (defaults to the site bench execute was run on)
 
-            # Set company as default
-            frappe.db.set_default("company", company_name)
-            frappe.db.set_default("country", country)
-            frappe.db.set_default("currency", currency)
-            frappe.db.commit()
-            print(f"[SETUP] Company created: {company_name}")
-        else:
-            # Company exists, ensure defaults are set
-            frappe.db.set_default("company", company_name)
-            frappe.db.set_default("country", country)
-            frappe.db.set_default("currency", currency)
-            frappe.db.commit()
-            print(f"[SETUP] Company already exists: {company_name}")
-        frappe.flags.in_setup_wizard = False
-
-        # Step 5: Create Fiscal Year
-        if not frappe.db.exists("Fiscal Year", fy_name):
-            print(f"[SETUP] Creating fiscal year: {fy_name}")
-            fy = frappe.get_doc({
-                "doctype": "Fiscal Year",
-                "year": fy_name,
-                "year_start_date": fy_start_date,
-                "year_end_date": fy_end_date,
-                "is_short_year": 0
-            })
-            fy.insert(ignore_permissions=True)
-            frappe.db.set_default("fiscal_year", fy_name)
-            frappe.db.commit()
-            print(f"[SETUP] Fiscal Year created: {fy_name}")
-        else:
-            frappe.db.set_default("fiscal_year", fy_name)
-            frappe.db.commit()
-            print(f"[SETUP] Fiscal Year exists: {fy_name}")
+    Returns:
+        list: {"site": str, "success": bool, "message": str} for each configuration
+    """
+    configs = _load_config(configs, configs_b64)
+    home_site = frappe.local.site
+    sites_path = frappe.local.sites_path
 
-        # Step 6: Configure ERPNext Settings (important for skipping setup wizard)
-        if frappe.db.exists("DocType", "ERPNext Settings"):
+    results = []
+    try:
+        for config in configs:
+            site = config.get("site") or home_site
             try:
-                erpnext_settings = frappe.get_single("ERPNext Settings")
-                erpnext_settings.setup_complete = 1
-                erpnext_settings.save(ignore_permissions=True)
-                frappe.db.commit()
-                print("[SETUP] ERPNext Settings updated with setup_complete=1")
+                _switch_site(site, sites_path)
             except Exception as e:
-                print(f"[SETUP] Warning: Could not update ERPNext Settings: {e}")
+                print(f"SETUP_FAILED: Could not connect to site {site}: {e!s}")
+                results.append({"site": site, "success": False, "message": str(e)})
+                continue
 
-        # Step 7: Set Global Defaults
-        if frappe.db.exists("DocType", "Global Defaults"):
-            try:
-                global_defaults = frappe.get_single("Global Defaults")
-                global_defaults.default_company = company_name
-                global_defaults.current_fiscal_year = fy_name
-                global_defaults.country = country
-                global_defaults.default_currency = currency
-                global_defaults.save(ignore_permissions=True)
-                frappe.db.commit()
-                print("[SETUP] Global Defaults updated")
-            except Exception as e:
-                print(f"[SETUP] Warning: Could not update Global Defaults: {e}")
+            print(f"[SETUP] Site: {site}")
+            results.append({"site": site, **setup_company(config=config)})
+    finally:
+        # bench execute commits and tears down the site it was started on
+        _switch_site(home_site, sites_path)
 
-        # Step 8: Set Stock Settings defaults
-        if frappe.db.exists("DocType", "Stock Settings"):
-            try:
-                stock_settings = frappe.get_single("Stock Settings")
-                stock_settings.stock_uom = "Nos"
-                stock_settings.save(ignore_permissions=True)
-                frappe.db.commit()
-                print("[SETUP] Stock Settings updated")
-            except Exception as e:
-                print(f"[SETUP] Warning: Could not update Stock Settings: {e}")
+    return results
 
-        # Step 9: Clear all caches to apply changes
-        frappe.clear_cache()
-        print("[SETUP] Cache cleared")
 
-        # Verify company was created
-        if frappe.db.exists("Company", company_name):
-            print("SETUP_SUCCESS")
-            return {"success": True, "message": f"Company {company_name} created successfully"}
-        else:
-            print(f"SETUP_FAILED: Company '{company_name}' not found after creation")
-            return {"success": False, "message": f"Company '{company_name}' not found after creation"}
+def _switch_site(site, sites_path):
+    """Point this process at another site and connect to its database."""
+    if getattr(frappe.local, "site", None) == site and getattr(frappe.local, "db", None):
+        return
 
-    except Exception as e:
-        print(f"SETUP_FAILED: {e!s}")
-        traceback.print_exc()
-        return {"success": False, "message": str(e)}
+    frappe.destroy()
+    frappe.init(site, sites_path=sites_path)
+    frappe.connect()
 
 
-def create_user(config_b64):
+def _setup_company(config):
+    """
+    Run the setup steps of setup_company on the current site.
+
+    Args:
+        config: Decoded configuration dict (see setup_company)
+
+    Returns:
+        dict: {"success": bool, "message": str}
+    """
+    company_name = config["company_name"]
+    company_abbr = config["company_abbr"]
+    country = config["country"]
+    currency = config["currency"]
+    chart_of_accounts = config.get("chart_of_accounts", "Standard")
+    fy_name = config["fy_name"]
+    fy_start_date = config["fy_start_date"]
+    fy_end_date = config["fy_end_date"]
+
+    print(f"[SETUP] Company: {company_name}, Abbr: {company_abbr}, Country: {country}")
+
+    # Set ignore permissions for all operations
+    frappe.flags.ignore_permissions = True
+
+    # Step 1: Mark setup complete in System Settings and disable onboarding
+    # (one set_value call: a single DELETE plus one multi-row INSERT on tabSingles for all fields)
+    frappe.db.set_value("System Settings", "System Settings", {
+        "setup_complete": 1,
+        "enable_onboarding": 0,
+        "country": country,
+        "language": "en",
+        "time_zone": "Asia/Kolkata"
+    }, update_modified=False)
+    print("[SETUP] System Settings updated with setup_complete=1, enable_onboarding=0")
+
+    # Step 1b: Mark all installed apps as setup complete in Installed Application table
+    # This is CRITICAL for ERPNext v16 - frappe.is_setup_complete() checks this table
+    # (one UPDATE for all apps; apps that are not installed simply match no rows)
+    frappe.db.sql(
+        "UPDATE `tabInstalled Application` SET is_setup_complete = 1 WHERE app_name IN %s",
+        [("frappe", "erpnext")]
+    )
+    print("[SETUP] Marked installed apps among frappe, erpnext as setup complete in Installed Application")
+
+    # Step 1c: Set desktop home page to prevent setup wizard from being the default landing page
+    # ROOT CAUSE FIX: Without this, desktop:home_page defaults to "setup-wizard" causing infinite redirect
+    # (global defaults are collected in `defaults` and written together in Step 7b)
+    defaults = {"desktop:home_page": "home"}
+
+    # Step 2: Create Warehouse Types (required for ERPNext Stock module)
+    # Warehouse Type has no controller logic, so missing rows are bulk inserted in one statement
+    warehouse_types = ["Transit", "Stores", "Goods In Transit", "Virtual"]
+    existing = set(frappe.get_all(
+        "Warehouse Type",
+        filters={"name": ["in", warehouse_types]},
+        pluck="name"
+    ))
+    missing = [wt for wt in warehouse_types if wt not in existing]
+    if missing:
+        now = frappe.utils.now()
+        user = frappe.session.user
+        frappe.db.bulk_insert(
+            "Warehouse Type",
+            fields=["name", "creation", "modified", "owner", "modified_by"],
+            values=[(wt, now, now, user, user) for wt in missing]
+        )
+        print(f"[SETUP] Created Warehouse Types: {', '.join(missing)}")
+
+    # Step 3: Create Company with Chart of Accounts
+    frappe.flags.in_setup_wizard = True
+    if not frappe.db.exists("Company", company_name):
+        print(f"[SETUP] Creating company: {company_name}")
+        company = frappe.get_doc({
+            "doctype": "Company",
+            "company_name": company_name,
+            "abbr": company_abbr,
+            "country": country,
+            "default_currency": currency,
+            "enable_perpetual_inventory": 1,
+            "chart_of_accounts": chart_of_accounts
+        })
+        company.insert(ignore_permissions=True)
+        print(f"[SETUP] Company created: {company_name}")
+    else:
+        print(f"[SETUP] Company already exists: {company_name}")
+    frappe.flags.in_setup_wizard = False
+
+    # Set company as default
+    defaults.update({"company": company_name, "country": country, "currency": currency})
+
+    # Step 4: Create Fiscal Year
+    if not frappe.db.exists("Fiscal Year", fy_name):
+        print(f"[SETUP] Creating fiscal year: {fy_name}")
+        fy = frappe.get_doc({
+            "doctype": "Fiscal Year",
+            "year": fy_name,
+            "year_start_date": fy_start_date,
+            "year_end_date": fy_end_date,
+            "is_short_year": 0
+        })
+        fy.insert(ignore_permissions=True)
+        print(f"[SETUP] Fiscal Year created: {fy_name}")
+    else:
+        print(f"[SETUP] Fiscal Year exists: {fy_name}")
+    defaults["fiscal_year"] = fy_name
+
+    # Settings singles below are written with one frappe.db.set_value call per doctype (two statements)
+    # instead of get_single() + save(), which reloads and rewrites every field of the doctype
+
+    # Steps 5-7 are optional: a failure rolls back to the step's savepoint and setup continues,
+    # so earlier work in the same transaction is kept. If the savepoint itself is gone (e.g. the
+    # database rolled back the whole transaction on a deadlock) the rollback raises and setup fails.
+
+    # Step 5: Configure ERPNext Settings (important for skipping setup wizard)
+    if frappe.db.exists("DocType", "ERPNext Settings"):
+        frappe.db.savepoint("erpnext_settings")
+        try:
+            frappe.db.set_value("ERPNext Settings", "ERPNext Settings", {
+                "setup_complete": 1
+            }, update_modified=False)
+            print("[SETUP] ERPNext Settings updated with setup_complete=1")
+        except Exception as e:
+            frappe.db.rollback(save_point="erpnext_settings")
+            print(f"[SETUP] Warning: Could not update ERPNext Settings: {e}")
+
+    # Step 6: Set Global Defaults
+    if frappe.db.exists("DocType", "Global Defaults"):
+        frappe.db.savepoint("global_defaults")
+        try:
+            frappe.db.set_value("Global Defaults", "Global Defaults", {
+                "default_company": company_name,
+                "current_fiscal_year": fy_name,
+                "country": country,
+                "default_currency": currency
+            }, update_modified=False)
+
+            # Previously applied by Global Defaults on_update
+            frappe.db.set_value("Currency", currency, "enabled", 1)
+            defaults.update({"year_start_date": fy_start_date, "year_end_date": fy_end_date})
+            print("[SETUP] Global Defaults updated")
+        except Exception as e:
+            frappe.db.rollback(save_point="global_defaults")
+            print(f"[SETUP] Warning: Could not update Global Defaults: {e}")
+
+    # Step 7: Set Stock Settings defaults
+    if frappe.db.exists("DocType", "Stock Settings"):
+        frappe.db.savepoint("stock_settings")
+        try:
+            frappe.db.set_value("Stock Settings", "Stock Settings", {
+                "stock_uom": "Nos"
+            }, update_modified=False)
+
+            # Previously applied by Stock Settings validate
+            defaults["stock_uom"] = "Nos"
+            print("[SETUP] Stock Settings updated")
+        except Exception as e:
+            frappe.db.rollback(save_point="stock_settings")
+            print(f"[SETUP] Warning: Could not update Stock Settings: {e}")
+
+    # Step 7b: Write all collected global defaults
+    _set_defaults(defaults)
+    print(f"[SETUP] Defaults set: {', '.join(defaults)}")
+
+    # All database changes are committed together
+    frappe.db.commit()
+
+    # Step 8: Mark setup complete in site_config.json (only once the database changes are committed)
+    # frappe.conf already holds the parsed config, so the file is only touched when the flag is missing.
+    # It is not written from frappe.conf because that also contains common_site_config.json values.
+    if frappe.conf.get("setup_complete"):
+        print("[SETUP] site_config.json already has setup_complete=1")
+    else:
+        update_site_config(lambda site_config: site_config.update(setup_complete=1))
+        frappe.conf.setup_complete = 1
+        print("[SETUP] site_config.json updated with setup_complete=1")
+
+    # Step 9: Clear the caches affected by the changes above
+    # (targeted instead of frappe.clear_cache(), so unrelated cached data stays warm)
+    for doctype, name in [
+        ("System Settings", "System Settings"),
+        ("Global Defaults", "Global Defaults"),
+        ("ERPNext Settings", "ERPNext Settings"),
+        ("Stock Settings", "Stock Settings"),
+        ("Company", company_name),
+        ("Fiscal Year", fy_name),
+        ("Currency", currency),
+    ]:
+        frappe.clear_document_cache(doctype, name)
+    # System defaults written in Step 7b (company, fiscal year, currency, home page)
+    frappe.defaults.clear_cache("__default")
+    # Boot info and home page embed setup_complete / desktop:home_page, time_zone is cached separately
+    frappe.cache().delete_value(["bootinfo", "home_page", "time_zone"])
+    print("[SETUP] Cache cleared")
+
+    # Verify company was created
+    if frappe.db.exists("Company", company_name):
+        print("SETUP_SUCCESS")
+        return {"success": True, "message": f"Company {company_name} created successfully"}
+    else:
+        print(f"SETUP_FAILED: Company '{company_name}' not found after creation")
+        return {"success": False, "message": f"Company '{company_name}' not found after creation"}
+
+
+def _set_defaults(defaults):
+    """
+    Set global defaults, like frappe.db.set_default, with one DELETE and one INSERT.
+
+    frappe.db.set_default locks, deletes and inserts each key separately and
+    clears every cache after each one.
+
+    Args:
+        defaults: dict of default key to value
+    """
+    frappe.db.delete("DefaultValue", {"parent": "__default", "defkey": ["in", list(defaults)]})
+
+    now = frappe.utils.now()
+    user = frappe.session.user
+    frappe.db.bulk_insert(
+        "DefaultValue",
+        fields=["name", "parent", "parentfield", "defkey", "defvalue", "creation", "modified", "owner", "modified_by"],
+        values=[
+            (frappe.generate_hash(length=10), "__default", "system_defaults", key, value, now, now, user, user)
+            for key, value in defaults.items()
+        ]
+    )
+    # Cleared once committed, so other workers can't re-cache the old values in between
+    frappe.db.after_commit.add(lambda: frappe.defaults.clear_cache("__default"))
+
+
+def _grant_role(user, role):
+    """Give `user` a role with a single Has Role insert, unless the user already has it."""
+    if frappe.db.exists("Has Role", {"parenttype": "User", "parent": user, "role": role}):
+        return
+
+    now = frappe.utils.now()
+    frappe.get_doc({
+        "doctype": "Has Role",
+        "parenttype": "User",
+        "parentfield": "roles",
+        "parent": user,
+        "role": role,
+        "creation": now,
+        "modified": now,
+        "owner": frappe.session.user,
+        "modified_by": frappe.session.user,
+    }).db_insert()
+
+
+def create_user(config_b64=None, config=None):
     """
     Create a user on a tenant site.
 
-    Called via bench execute with base64-encoded configuration.
+    Called via bench execute with the configuration as JSON (or base64-encoded JSON).
 
     Args:
-        config_b64: Base64-encoded JSON containing:
+        config_b64: Base64-encoded JSON configuration (used when `config` is not given)
+        config: Configuration dict or JSON string containing:
             - email
             - first_name
             - last_name
@@ -229,7 +402,7 @@ def create_user(config_b64):
         from frappe.utils.password import update_password
 
         # Decode configuration
-        config = json.loads(base64.b64decode(config_b64).decode())
+        config = _load_config(config, config_b64)
 
         email = config["email"]
         first_name = config.get("first_name", "User")
@@ -244,18 +417,23 @@ def create_user(config_b64):
         if frappe.db.exists("User", email):
             # Update existing user password
             update_password(email, password)
-            frappe.db.commit()
             # Ensure user is enabled and has correct roles
-            user = frappe.get_doc("User", email)
-            user.enabled = 1
-            if "System Manager" not in [r.role for r in user.roles]:
-                user.add_roles("System Manager")
-            user.save(ignore_permissions=True)
+            # (direct writes instead of loading and saving the whole User document; user_type is set here
+            # because User.validate, which promotes users with desk roles to System User, does not run)
+            frappe.db.set_value("User", email, {
+                "enabled": 1,
+                "user_type": "System User"
+            }, update_modified=False)
+            _grant_role(email, "System Manager")
+            # set_value skips the doc events that keep the cached user count for the plan limit in sync
+            clear_cached_count("User")
             frappe.db.commit()
+            frappe.clear_cache(user=email)
             print(f"USER_SUCCESS: User {email} exists, password and roles updated")
             return {"success": True, "message": f"User {email} updated"}
         else:
-            # Create new user
+            # Create new user with the System Manager role
+            # (inserted together with the user instead of a separate add_roles() save)
             user = frappe.get_doc({
                 "doctype": "User",
                 "email": email,
@@ -264,29 +442,29 @@ def create_user(config_b64):
                 "enabled": 1,
                 "user_type": "System User",
                 "send_welcome_email": 0,
+                "roles": [{"role": "System Manager"}],
             })
             user.insert(ignore_permissions=True)
 
             # Set password after creation
             update_password(email, password)
-            frappe.db.commit()
-
-            # Add System Manager role
-            user.add_roles("System Manager")
-            frappe.db.commit()
             print(f"USER_SUCCESS: User {email} created successfully")
 
         # Also set Administrator password for "Login as Admin" functionality
+        # (optional: a failure rolls back to the savepoint so the user changes above are kept)
+        frappe.db.savepoint("administrator_password")
         try:
             update_password("Administrator", password)
-            frappe.db.commit()
             print("[USER] Administrator password also updated")
         except Exception as admin_err:
+            frappe.db.rollback(save_point="administrator_password")
             print(f"[USER] Warning: Could not update Administrator password: {admin_err}")
 
+        frappe.db.commit()
         return {"success": True, "message": f"User {email} created/updated"}
 
     except Exception as e:
+        frappe.db.rollback()
         print(f"USER_FAILED: {e!s}")
         traceback.print_exc()
         return {"success": False, "message": str(e)}
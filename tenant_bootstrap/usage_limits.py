@@ -4,15 +4,76 @@ Validates that tenants don't exceed their plan limits.
 """
 
 import frappe
-from frappe import _
+from frappe import _, _lt
+from frappe.query_builder.functions import Count
+from frappe.utils import get_first_day, get_last_day, today
+
+from tenant_bootstrap.utils import load_site_config, save_site_config, site_config_lock
 
 
 # Cache key for plan limits
 LIMITS_CACHE_KEY = "saas_plan_limits"
 
+# Site config key for the controller's version of the stored plan limits
+LIMITS_VERSION_KEY = "saas_plan_limits_version"
+
+# Largest accepted version (it has to fit a signed 64-bit integer to be written to site config)
+MAX_LIMITS_VERSION = 2**63 - 1
+
+# Plan limits checked on insert, per doctype: plan limit key, filters for the
+# records counted against it, and the message shown once it is reached
+LIMIT_RULES = {
+    "User": {
+        "limit_key": "max_users",
+        "filters": [
+            ["enabled", "=", 1],
+            ["user_type", "=", "System User"],
+            ["name", "not in", ["Administrator", "Guest"]],
+        ],
+        "message": _lt("You have reached the maximum number of users ({0}) allowed in your plan. Please upgrade your plan to add more users."),
+        "title": _lt("User Limit Reached"),
+    },
+    "Customer": {
+        "limit_key": "max_customers",
+        "filters": [],
+        "message": _lt("You have reached the maximum number of customers ({0}) allowed in your plan. Please upgrade your plan to add more customers."),
+        "title": _lt("Customer Limit Reached"),
+    },
+    "Supplier": {
+        "limit_key": "max_suppliers",
+        "filters": [],
+        "message": _lt("You have reached the maximum number of suppliers ({0}) allowed in your plan. Please upgrade your plan to add more suppliers."),
+        "title": _lt("Supplier Limit Reached"),
+    },
+    "Company": {
+        "limit_key": "max_companies",
+        "filters": [],
+        "message": _lt("You have reached the maximum number of companies ({0}) allowed in your plan. Please upgrade your plan to add more companies."),
+        "title": _lt("Company Limit Reached"),
+    },
+}
+
+# Cache key prefix for record counts used by the limit validators
+COUNT_CACHE_KEY = "saas_usage_count"
+
+# Cached counts expire after this many seconds, bounding any drift
+COUNT_CACHE_TTL = 3600
+
+# Below this fraction of a limit the cached count is trusted without recounting
+COUNT_RECHECK_RATIO = 0.9
+
+# Limits from which the table's estimated row count is used as a pre-check
+# (smaller limits are cheap to count exactly and estimates are least reliable there)
+ESTIMATE_MIN_LIMIT = 1000
+
 
 def get_plan_limits():
     """Get cached plan limits for this tenant site."""
+    # Limits only change through sync_plan_limits, so Redis is read at most once per request
+    limits = getattr(frappe.local, "saas_plan_limits", None)
+    if limits is not None:
+        return limits
+
     limits = frappe.cache().get_value(LIMITS_CACHE_KEY)
 
     if not limits:
@@ -21,125 +82,186 @@ def get_plan_limits():
         if limits:
             frappe.cache().set_value(LIMITS_CACHE_KEY, limits)
 
-    return limits or {}
+    frappe.local.saas_plan_limits = limits or {}
+    return frappe.local.saas_plan_limits
 
 
-def set_plan_limits(limits):
-    """Store plan limits in cache and site config."""
-    frappe.cache().set_value(LIMITS_CACHE_KEY, limits)
+def set_plan_limits(limits, version=None):
+    """
+    Store plan limits in cache and site config.
 
-    # Also update site config for persistence
-    site_config_path = frappe.get_site_path("site_config.json")
-    try:
-        import json
-        with open(site_config_path, "r") as f:
-            config = json.load(f)
+    The version check, the cache update and the site config write all run
+    under `site_config_lock()`, so a concurrent older update can neither
+    pass the check nor overwrite newer limits.
+
+    Args:
+        limits: dict of plan limits
+        version: Version of the limits on the SaaS controller; limits older than
+            the stored version are ignored, so the latest update wins
 
+    Returns:
+        bool: False if the limits were ignored as outdated
+    """
+    with site_config_lock():
+        config = load_site_config()
+        if version is not None:
+            stored_version = config.get(LIMITS_VERSION_KEY)
+            if stored_version is not None and version < stored_version:
+                return False
+
+        frappe.cache().set_value(LIMITS_CACHE_KEY, limits)
+        frappe.local.saas_plan_limits = limits
+
+        # Also update site config for persistence
+        # (saved directly, update_site_config would try to take the lock again)
         config["saas_plan_limits"] = limits
+        if version is not None:
+            config[LIMITS_VERSION_KEY] = version
+        try:
+            save_site_config(config)
+        except Exception as e:
+            frappe.log_error(f"Failed to save plan limits to site config: {e}")
 
-        with open(site_config_path, "w") as f:
-            json.dump(config, f, indent=2)
-    except Exception as e:
-        frappe.log_error(f"Failed to save plan limits to site config: {e}")
+    return True
 
 
-def validate_user_limit(doc, method=None):
-    """Validate user creation against plan limit."""
-    if doc.user_type != "System User":
-        return
+def _count_cache_key(doctype):
+    return f"{COUNT_CACHE_KEY}:{doctype}"
 
-    # Skip for Administrator and Guest
-    if doc.name in ["Administrator", "Guest"]:
-        return
 
-    limits = get_plan_limits()
-    max_users = limits.get("max_users", 0)
+def _count_upto(doctype, filters, limit):
+    """
+    Count records of a doctype matching `filters`, stopping at `limit`.
 
-    # 0 = Unlimited
-    if not max_users:
-        return
+    The database stops reading rows once `limit` matches are found, which is
+    all a limit check needs, instead of counting every matching row.
+    """
+    matches = frappe.qb.get_query(doctype, fields=["name"], filters=filters, limit=limit)
+    return frappe.qb.from_(matches).select(Count("*")).run()[0][0]
 
-    # Count current users
-    current_users = frappe.db.count("User", filters={
-        "enabled": 1,
-        "user_type": "System User",
-        "name": ["not in", ["Administrator", "Guest", doc.name]]
-    })
 
-    if current_users >= max_users:
-        frappe.throw(
-            _("You have reached the maximum number of users ({0}) allowed in your plan. Please upgrade your plan to add more users.").format(max_users),
-            title=_("User Limit Reached")
-        )
+def _cached_count(doctype, filters, limit):
+    """
+    Count records of a doctype, served from cache while well below the limit.
 
+    Once the cached count gets close to `limit` the records are counted
+    again, so the decision at the limit boundary is always exact. Doctypes
+    written to in the current request are always counted, since the shared
+    cache cannot include this transaction's uncommitted rows.
+    """
+    key = _count_cache_key(doctype)
+    uncommitted = doctype in getattr(frappe.local, "saas_uncommitted_counts", ())
 
-def validate_customer_limit(doc, method=None):
-    """Validate customer creation against plan limit."""
-    limits = get_plan_limits()
-    max_customers = limits.get("max_customers", 0)
+    if not uncommitted:
+        count = frappe.cache().get_value(key)
+        if count is not None and count + 1 < limit * COUNT_RECHECK_RATIO:
+            return count
 
-    # 0 = Unlimited
-    if not max_customers:
-        return
+    count = _count_upto(doctype, filters, limit)
+    if uncommitted:
+        # Includes uncommitted rows, which must not reach the shared cache
+        return count
 
-    # Count current customers (excluding this one if it's being updated)
-    filters = {}
-    if not doc.is_new():
-        filters["name"] = ["!=", doc.name]
+    if count < limit:
+        frappe.cache().set_value(key, count, expires_in_sec=COUNT_CACHE_TTL)
+    else:
+        # A count capped at the limit is not the real count, don't reuse it
+        frappe.cache().delete_value(key)
+    return count
 
-    current_customers = frappe.db.count("Customer", filters=filters)
 
-    if current_customers >= max_customers:
-        frappe.throw(
-            _("You have reached the maximum number of customers ({0}) allowed in your plan. Please upgrade your plan to add more customers.").format(max_customers),
-            title=_("Customer Limit Reached")
-        )
+def clear_cached_count(doctype):
+    """
+    Drop the cached record count of a doctype after its records changed.
 
+    The key is deleted rather than adjusted, as a read-modify-write on the
+    cached value is not atomic, and deleted again once the transaction
+    commits so a count taken concurrently from before the commit is not
+    kept. A rolled back change only costs an extra recount.
+    """
+    if not hasattr(frappe.local, "saas_uncommitted_counts"):
+        frappe.local.saas_uncommitted_counts = set()
+    frappe.local.saas_uncommitted_counts.add(doctype)
+
+    key = _count_cache_key(doctype)
+    frappe.cache().delete_value(key)
+    frappe.db.after_commit.add(lambda: frappe.cache().delete_value(key))
+
+
+def invalidate_cached_count(doc, method=None):
+    """Drop the cached record count after an insert, delete or relevant update."""
+    if method == "on_update":
+        # Enabling, disabling or changing the type of a user changes who counts towards the user limit
+        if not (doc.has_value_changed("enabled") or doc.has_value_changed("user_type")):
+            return
+    elif not _counts_towards_limit(doc):
+        return
 
-def validate_supplier_limit(doc, method=None):
-    """Validate supplier creation against plan limit."""
-    limits = get_plan_limits()
-    max_suppliers = limits.get("max_suppliers", 0)
+    clear_cached_count(doc.doctype)
 
-    # 0 = Unlimited
-    if not max_suppliers:
-        return
 
-    # Count current suppliers (excluding this one if it's being updated)
-    filters = {}
-    if not doc.is_new():
-        filters["name"] = ["!=", doc.name]
+def _estimated_count(doctype):
+    """Get the approximate row count of a doctype's table from database statistics, once per request."""
+    estimates = getattr(frappe.local, "saas_row_estimates", None)
+    if estimates is None:
+        estimates = frappe.local.saas_row_estimates = {}
 
-    current_suppliers = frappe.db.count("Supplier", filters=filters)
+    if doctype not in estimates:
+        estimates[doctype] = frappe.db.estimate_count(doctype)
+    return estimates[doctype]
 
-    if current_suppliers >= max_suppliers:
-        frappe.throw(
-            _("You have reached the maximum number of suppliers ({0}) allowed in your plan. Please upgrade your plan to add more suppliers.").format(max_suppliers),
-            title=_("Supplier Limit Reached")
-        )
 
+def _counts_towards_limit(doc):
+    """Check whether a document is counted against its doctype's plan limit."""
+    # Only System Users count towards the user limit, Administrator and Guest never do
+    if doc.doctype == "User":
+        return doc.user_type == "System User" and doc.name not in ["Administrator", "Guest"]
+    return True
+
+
+def validate_limit(doc, method=None):
+    """Validate document creation against the plan limit for its doctype (see LIMIT_RULES)."""
+    rule = LIMIT_RULES.get(doc.doctype)
+    if not rule or not _counts_towards_limit(doc):
+        return
 
-def validate_company_limit(doc, method=None):
-    """Validate company creation against plan limit."""
     limits = get_plan_limits()
-    max_companies = limits.get("max_companies", 0)
+    max_records = limits.get(rule["limit_key"], 0)
 
     # 0 = Unlimited
-    if not max_companies:
+    if not max_records:
         return
 
-    # Count current companies (excluding this one if it's being updated)
-    filters = {}
+    # Whole table comfortably below the limit, no need to count matching records
+    # (the estimate is memoised per request, so it is only trusted until this request writes the doctype)
+    if (
+        max_records >= ESTIMATE_MIN_LIMIT
+        and doc.doctype not in getattr(frappe.local, "saas_uncommitted_counts", ())
+        and _estimated_count(doc.doctype) < max_records * COUNT_RECHECK_RATIO
+    ):
+        return
+
+    # Count current records (excluding this one if it's being updated)
+    filters = list(rule["filters"])
     if not doc.is_new():
-        filters["name"] = ["!=", doc.name]
+        filters.append(["name", "!=", doc.name])
 
-    current_companies = frappe.db.count("Company", filters=filters)
+    current_records = _cached_count(doc.doctype, filters, max_records)
 
-    if current_companies >= max_companies:
-        frappe.throw(
-            _("You have reached the maximum number of companies ({0}) allowed in your plan. Please upgrade your plan to add more companies.").format(max_companies),
-            title=_("Company Limit Reached")
-        )
+    if current_records >= max_records:
+        frappe.throw(str(rule["message"]).format(max_records), title=str(rule["title"]))
+
+
+def _month_bounds():
+    """Get the first and last day of the current month, computed once per request and day."""
+    current_date = today()
+    cached = getattr(frappe.local, "saas_month_bounds", None)
+    if cached and cached[0] == current_date:
+        return cached[1:]
+
+    bounds = (get_first_day(current_date), get_last_day(current_date))
+    frappe.local.saas_month_bounds = (current_date, *bounds)
+    return bounds
 
 
 def validate_invoice_limit(doc, method=None):
@@ -156,15 +278,13 @@ def validate_invoice_limit(doc, method=None):
         return
 
     # Count invoices this month
-    from frappe.utils import get_first_day, get_last_day, today
-    first_day = get_first_day(today())
-    last_day = get_last_day(today())
+    first_day, last_day = _month_bounds()
 
-    current_invoices = frappe.db.count("Sales Invoice", filters={
+    current_invoices = _count_upto("Sales Invoice", {
         "docstatus": 1,
         "posting_date": ["between", [first_day, last_day]],
         "name": ["!=", doc.name]
-    })
+    }, max_invoices)
 
     if current_invoices >= max_invoices:
         frappe.throw(
@@ -180,12 +300,16 @@ def sync_plan_limits(
     max_suppliers=0,
     max_companies=0,
     max_invoices_per_month=0,
-    max_storage_gb=0
+    max_storage_gb=0,
+    version=None
 ):
     """
     API to receive plan limits from the SaaS controller.
     Called when plan is assigned or changed.
 
+    The limits are stored by a background job on the short queue, so the
+    controller gets a response without waiting for the write.
+
     Args:
         max_users: Maximum system users (0 = unlimited)
         max_customers: Maximum customers (0 = unlimited)
@@ -193,6 +317,8 @@ def sync_plan_limits(
         max_companies: Maximum companies (0 = unlimited)
         max_invoices_per_month: Maximum invoices per month (0 = unlimited)
         max_storage_gb: Maximum storage in GB
+        version: Increasing version of the plan limits on the controller (optional, only
+            honoured for authenticated calls so a guest cannot block later updates)
 
     Returns:
         dict: Success status
@@ -207,9 +333,23 @@ def sync_plan_limits(
             "max_storage_gb": float(max_storage_gb) if max_storage_gb else 0
         }
 
-        set_plan_limits(limits)
+        # A stored version makes older updates be ignored, so only trust it from authenticated callers
+        if frappe.session.user == "Guest" or version in (None, ""):
+            version = None
+        else:
+            version = int(version)
+            if not 0 <= version <= MAX_LIMITS_VERSION:
+                raise ValueError(f"version must be between 0 and {MAX_LIMITS_VERSION}")
+
+        frappe.enqueue(
+            "tenant_bootstrap.usage_limits.set_plan_limits",
+            queue="short",
+            limits=limits,
+            version=version,
+            now=frappe.flags.in_test
+        )
 
-        return {"success": True, "message": "Plan limits updated", "limits": limits}
+        return {"success": True, "message": "Plan limits update queued", "limits": limits, "queued": True}
 
     except Exception as e:
         frappe.log_error(f"Failed to sync plan limits: {e}")
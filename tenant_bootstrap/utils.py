@@ -0,0 +1,101 @@
+"""
+Shared helpers for tenant setup and usage limits.
+"""
+
+import os
+import tempfile
+
+import frappe
+import orjson
+from frappe.utils.synchronization import filelock
+
+# Parsed site_config.json per file path: {path: (file_stamp, config)}
+_site_config_cache = {}
+
+
+def _file_stamp(path):
+    """Return a value that changes whenever the file at `path` is rewritten."""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_site_config():
+    """
+    Get the parsed site_config.json of the current site.
+
+    The parsed dict is kept per process and only re-read when the file's
+    mtime or size changes, so repeated calls cost a single stat().
+
+    Returns:
+        dict: A copy of the site config that callers may modify
+    """
+    site_config_path = frappe.get_site_path("site_config.json")
+    stamp = _file_stamp(site_config_path)
+
+    cached = _site_config_cache.get(site_config_path)
+    if not cached or cached[0] != stamp:
+        with open(site_config_path, "rb") as f:
+            cached = (stamp, orjson.loads(f.read()))
+        _site_config_cache[site_config_path] = cached
+
+    return dict(cached[1])
+
+
+def _atomic_write_json(path, obj):
+    """
+    Write `obj` as JSON to `path` without ever leaving a partially written file.
+
+    The JSON is written and fsynced to a temporary file in the same directory,
+    which then replaces `path` in a single rename.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".site_config.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_site_config(config):
+    """Atomically write site_config.json of the current site and refresh the cached copy."""
+    site_config_path = frappe.get_site_path("site_config.json")
+    _atomic_write_json(site_config_path, config)
+
+    _site_config_cache[site_config_path] = (_file_stamp(site_config_path), dict(config))
+
+
+def site_config_lock():
+    """
+    Lock site_config.json of the current site against concurrent writers.
+
+    This is the same lock `frappe.installer.update_site_config` takes, so it
+    also serialises against bench commands. It is not reentrant.
+    """
+    return filelock("site_config")
+
+
+def update_site_config(update):
+    """
+    Read site_config.json of the current site once, apply `update` to it and write it back.
+
+    The read-modify-write runs under `site_config_lock()` so concurrent
+    updates can't drop each other's keys.
+
+    Args:
+        update: Function that modifies the config dict in place
+
+    Returns:
+        dict: The updated site config
+    """
+    with site_config_lock():
+        config = load_site_config()
+        update(config)
+        save_site_config(config)
+    return config